@@ -1,5 +1,15 @@
 import requests
 import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# connection pool settings for the session shared by all calls of a client
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 32
+MAX_RETRIES = Retry(total=5,
+                    backoff_factor=0.3,
+                    status_forcelist=[502, 503, 504],
+                    raise_on_status=False)
 
 
 class AuthException(Exception):
@@ -32,7 +42,7 @@ def _api_versions(server_name, server_address, endpoints_common, auth_header):
     if url_base is not None:
         url = url_base.format_map(url_mapping)
         response = requests.get(url, headers=auth_header)
-        self.raise_for_status(response)
+        ClientBase.raise_for_status(response)
         return response.json()
     else:
         return None
@@ -78,6 +88,11 @@ class ClientBase(object):
         self._default_url_mapping = {server_name: self._server_address}
 
         self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                              pool_maxsize=POOL_MAXSIZE,
+                              max_retries=MAX_RETRIES)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         head_val = auth_header.get('Authorization', None)
         if head_val is not None:
             token = head_val.split(' ')[1]
@@ -106,17 +121,17 @@ class ClientBase(object):
         """Raises :class:`HTTPError`, if one occurred."""
 
         http_error_msg = ''
-        if isinstance(r.reason, bytes):
+        # httpx responses (MaterializationClient transport='httpx') call it reason_phrase
+        reason = r.reason if hasattr(r, 'reason') else r.reason_phrase
+        if isinstance(reason, bytes):
             # We attempt to decode utf-8 first because some servers
             # choose to localize their reason strings. If the string
             # isn't utf-8, we fall back to iso-8859-1 for all other
             # encodings. (See PR #3538)
             try:
-                reason = r.reason.decode('utf-8')
+                reason = reason.decode('utf-8')
             except UnicodeDecodeError:
-                reason = r.reason.decode('iso-8859-1')
-        else:
-            reason = r.reason
+                reason = reason.decode('iso-8859-1')
 
         if 400 <= r.status_code < 500:
             http_error_msg = u'%s Client Error: %s for url: %s content: %s' % (r.status_code, reason, r.url, r.content)
@@ -1,15 +1,42 @@
-from .base import ClientBaseWithDataset, ClientBaseWithDatastack, ClientBase, _api_versions, _api_endpoints
+from .base import ClientBaseWithDataset, ClientBaseWithDatastack, ClientBase, _api_versions, _api_endpoints, POOL_MAXSIZE
 from .auth import AuthClient
 from .endpoints import materialization_api_versions, materialization_common
 from .infoservice import InfoServiceClientV2
 import requests
+from urllib3.util.retry import Retry
 import time
 import json
+from collections import OrderedDict
+import gzip
+import asyncio
+import functools
 import numpy as np
 from datetime import date, datetime
 import pyarrow as pa
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import httpx
+except ImportError:
+    httpx = None
+from concurrent.futures import ThreadPoolExecutor
 SERVER_KEY = "me_server_address"
 
+# maximum number of annotation ids to send in a single request
+ANNOTATION_BATCH_SIZE = 10000
+# seconds for which version, table and metadata lookups are cached
+CACHE_TTL = 60
+# maximum number of responses kept in the cache of a client
+CACHE_MAXSIZE = 64
+# request bodies larger than this many bytes are gzipped if compression is on
+COMPRESSION_THRESHOLD = 2048
+# seconds to wait for the connection opened when a client is created
+WARM_UP_TIMEOUT = 2
+# maximum number of concurrent requests issued by the bulk methods
+MAX_WORKERS = 16
+
 
 class MEEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -24,12 +51,80 @@ class MEEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def _orjson_default(obj):
+    # handles the same cases as MEEncoder for whatever orjson does not
+    # serialize natively, e.g. non-contiguous arrays or datetime subclasses
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def _dumps(data):
+    """Serialize a request body to bytes, using orjson when it is installed
+    so that numpy arrays are serialized from their buffers without building
+    lists"""
+    if orjson is not None:
+        return orjson.dumps(data,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+                            default=_orjson_default)
+    return json.dumps(data, cls=MEEncoder).encode('utf-8')
+
+
+def _annotation_id_array(annotation_ids):
+    """Convert annotation ids to an integer array without truncating
+    floats or wrapping ids of 2**63 and above"""
+    if isinstance(annotation_ids, np.ndarray):
+        annotation_ids = np.atleast_1d(annotation_ids)
+        if not np.issubdtype(annotation_ids.dtype, np.integer):
+            raise TypeError('annotation_ids must be integers, '
+                            f'got {annotation_ids.dtype}')
+        return annotation_ids
+    annotation_ids = list(annotation_ids)
+    for a in annotation_ids:
+        if isinstance(a, bool) or not isinstance(a, (int, np.integer)):
+            raise TypeError('annotation_ids must be integers, '
+                            f'got {type(a).__name__}')
+    if any(a >= 2**63 for a in annotation_ids):
+        return np.array(annotation_ids, dtype=np.uint64)
+    return np.array(annotation_ids, dtype=np.int64)
+
+
+# stands in for the id list while serializing a prepared query
+PREPARED_QUERY_PLACEHOLDER = '__prepared_query_ids__'
+
+ARROW_STREAM_MIME = 'application/vnd.apache.arrow.stream'
+
+
+def _deserialize_query_response(response):
+    """Decode a query response into a pandas dataframe.
+
+    Arrow IPC streams are read directly from the response buffer without
+    an intermediate copy, with dtypes taken from the arrow schema. Anything
+    else is treated as a legacy pyarrow serialized payload.
+    """
+    content_type = response.headers.get('Content-Type', '')
+    if content_type.startswith(ARROW_STREAM_MIME):
+        reader = pa.ipc.open_stream(pa.py_buffer(response.content))
+        # the arrow columns already carry the table's dtypes, so pandas does
+        # no type inference. Do not use split_blocks or zero_copy_only here:
+        # pandas would wrap read-only views of the response buffer and
+        # callers could no longer assign into their results
+        return reader.read_pandas()
+    return pa.deserialize(response.content)
+
+
 def MaterializationClient(server_address,
                           datastack_name=None,
                           auth_client=None,
                           api_version='latest',
                           version=None,
-                          verify=True):
+                          verify=True,
+                          compress_requests=False,
+                          transport='requests'):
     """ Factory for returning AnnotationClient
     Parameters
     ----------
@@ -45,6 +140,15 @@ def MaterializationClient(server_address,
         'latest': default to the most recent (current 2)
     version : default version to query
         if None will default to latest version
+    compress_requests : bool, optional
+        If True, gzip query bodies larger than COMPRESSION_THRESHOLD bytes.
+        Only use this if the server accepts gzip encoded requests. By default False.
+    transport : 'requests' or 'httpx', optional
+        HTTP library used to talk to the server. 'httpx' uses an HTTP/2
+        connection, which multiplexes concurrent requests and compresses
+        repeated headers such as the auth token, and needs httpx[http2]
+        to be installed. Unlike 'requests', it does not retry failed
+        requests. By default 'requests'.
     Returns
     -------
     ClientBaseWithDatastack
@@ -61,22 +165,74 @@ def MaterializationClient(server_address,
     MatClient = client_mapping[api_version]
     return MatClient(server_address, auth_header, api_version,
                      endpoints, SERVER_KEY, datastack_name,
-                     version=version, verify=verify)
+                     version=version, verify=verify,
+                     compress_requests=compress_requests,
+                     transport=transport)
 
 
 class MaterializatonClientV2(ClientBase):
     def __init__(self, server_address, auth_header, api_version,
                  endpoints, server_name, datastack_name, version=None,
-                 verify=True):
+                 verify=True, compress_requests=False, transport='requests'):
         super(MaterializatonClientV2, self).__init__(server_address,
                                                      auth_header, api_version, endpoints, server_name)
+        # verify is fixed for the client, so it is set on the session
+        # instead of being passed to every call
+        if transport == 'httpx':
+            if httpx is None:
+                raise ImportError("transport='httpx' requires httpx, "
+                                  "install it with pip install httpx[http2]")
+            requests_session = self.session
+            self.session = httpx.Client(http2=True,
+                                        verify=verify,
+                                        headers=auth_header,
+                                        cookies=requests_session.cookies,
+                                        limits=httpx.Limits(max_connections=POOL_MAXSIZE))
+            requests_session.close()
+        elif transport == 'requests':
+            self.session.verify = verify
+        else:
+            raise ValueError(f'Unknown transport {transport}')
+        self._transport = transport
 
         self._datastack_name = datastack_name
         self._verify = verify
+        self._compress_requests = compress_requests
+        self._cache = OrderedDict()
+        self._url_cache = {}
         if version is None:
             version = self.most_recent_version()
+        else:
+            # looking up the version would otherwise open the first connection
+            self._warm_up_connection()
         self._version = version
 
+    def _warm_up_connection(self):
+        """Open a pooled connection to the server so that the first query
+        does not pay for the TCP and TLS handshake"""
+        if self._transport == 'httpx':
+            # httpx does not retry, so the timeout bounds the wait
+            try:
+                self.session.head(self.server_address, timeout=WARM_UP_TIMEOUT)
+            except (httpx.HTTPError, httpx.InvalidURL):
+                pass
+            return
+        try:
+            adapter = self.session.get_adapter(self.server_address)
+        except requests.exceptions.RequestException:
+            return
+        # without retries WARM_UP_TIMEOUT bounds the wait. The adapter belongs
+        # to this client and nothing else can use the session yet, so
+        # swapping its retries for one request is safe
+        max_retries = adapter.max_retries
+        adapter.max_retries = Retry(0, read=False)
+        try:
+            self.session.head(self.server_address, timeout=WARM_UP_TIMEOUT)
+        except requests.exceptions.RequestException:
+            pass
+        finally:
+            adapter.max_retries = max_retries
+
     @property
     def datastack_name(self):
         return self._datastack_name
@@ -92,6 +248,64 @@ class MaterializatonClientV2(ClientBase):
         else:
             raise ValueError('Version not in materialized database')
 
+    def _format_url(self, endpoint_key, **kwargs):
+        """Format an endpoint url, reusing the result for repeated arguments
+        and leaving the default url mapping untouched"""
+        key = (endpoint_key, tuple(sorted(kwargs.items())))
+        url = self._url_cache.get(key)
+        if url is None:
+            endpoint_mapping = dict(self.default_url_mapping, **kwargs)
+            url = self._endpoints[endpoint_key].format_map(endpoint_mapping)
+            self._url_cache[key] = url
+        return url
+
+    def refresh(self):
+        """Clear cached versions, table lists and table metadata so the
+        next lookup goes to the server"""
+        self._cache.clear()
+
+    def _get_json_cached(self, url):
+        """GET a url and return its json, reusing a previous response
+        for the same url for up to CACHE_TTL seconds"""
+        content = self._cache_get(url)
+        if content is not None:
+            return json.loads(content)
+        response = self.session.get(url)
+        self.raise_for_status(response)
+        self._cache_put(url, response.content)
+        return response.json()
+
+    def _get_json_cached_concurrent(self, urls):
+        """like _get_json_cached for several urls, fetching the ones not
+        in the cache concurrently"""
+        contents = {url: self._cache_get(url) for url in urls}
+        missing = [url for url, content in contents.items() if content is None]
+        for url, response in zip(missing, self._get_concurrent(missing)):
+            self._cache_put(url, response.content)
+            contents[url] = response.content
+        return [json.loads(contents[url]) for url in urls]
+
+    def _cache_get(self, url):
+        # the raw response body is cached and decoded on every hit, so
+        # callers always get a fresh object they are free to modify
+        cached = self._cache.get(url)
+        if cached is None:
+            return None
+        if time.time() - cached[0] >= CACHE_TTL:
+            del self._cache[url]
+            return None
+        return cached[1]
+
+    def _cache_put(self, url, content):
+        now = time.time()
+        for cached_url in [u for u, (t, _) in self._cache.items()
+                           if now - t >= CACHE_TTL]:
+            del self._cache[cached_url]
+        self._cache.pop(url, None)
+        self._cache[url] = (now, content)
+        while len(self._cache) > CACHE_MAXSIZE:
+            self._cache.popitem(last=False)
+
     def most_recent_version(self, datastack_name=None):
         """get the most recent version of materialization 
         for this datastack name
@@ -112,12 +326,8 @@ class MaterializatonClientV2(ClientBase):
         """
         if datastack_name is None:
             datastack_name = self.datastack_name
-        endpoint_mapping = self.default_url_mapping
-        endpoint_mapping["datastack_name"] = datastack_name
-        url = self._endpoints["versions"].format_map(endpoint_mapping)
-        response = self.session.get(url, verify=self._verify)
-        self.raise_for_status(response)
-        return response.json()
+        url = self._format_url("versions", datastack_name=datastack_name)
+        return self._get_json_cached(url)
 
     def get_tables(self, datastack_name=None, version=None):
         """ Gets a list of table names for a datastack
@@ -139,15 +349,11 @@ class MaterializatonClientV2(ClientBase):
             datastack_name = self.datastack_name
         if version is None:
             version = self.version
-        endpoint_mapping = self.default_url_mapping
-        endpoint_mapping["datastack_name"] = datastack_name
-        endpoint_mapping["version"] = version
         # TODO fix up latest version
-        url = self._endpoints["tables"].format_map(endpoint_mapping)
+        url = self._format_url("tables", datastack_name=datastack_name,
+                               version=version)
 
-        response = self.session.get(url, verify=self._verify)
-        self.raise_for_status(response)
-        return response.json()
+        return self._get_json_cached(url)
 
     def get_annotation_count(self, table_name: str,
                              datastack_name=None,
@@ -169,17 +375,48 @@ class MaterializatonClientV2(ClientBase):
         """
         if datastack_name is None:
             datastack_name = self.datastack_name
+        if version is None:
+            version = self.version
 
-        endpoint_mapping = self.default_url_mapping
-        endpoint_mapping["datastack_name"] = datastack_name
-        endpoint_mapping["table_name"] = table_name
-
-        url = self._endpoints["table_count"].format_map(endpoint_mapping)
+        url = self._format_url("table_count", datastack_name=datastack_name,
+                               version=version, table_name=table_name)
 
-        response = self.session.get(url, verify=self._verify)
+        response = self.session.get(url)
         self.raise_for_status(response)
         return response.json()
 
+    def get_annotation_counts_bulk(self, table_names,
+                                   datastack_name=None,
+                                   version=None):
+        """ Get number of annotations in several tables with concurrent requests
+
+        Parameters
+        ----------
+        table_names (list of str):
+            names of tables to count
+        datastack_name: str or None, optional,
+            Name of the datastack_name. If None, uses the one specified in the client.
+        version: int or None, optional
+            the version to query, else get the tables in the most recent version
+        Returns
+        -------
+        dict
+            number of annotations keyed by table name
+        """
+        if datastack_name is None:
+            datastack_name = self.datastack_name
+        if version is None:
+            version = self.version
+
+        urls = []
+        for table_name in table_names:
+            urls.append(self._format_url("table_count",
+                                         datastack_name=datastack_name,
+                                         version=version,
+                                         table_name=table_name))
+        responses = self._get_concurrent(urls)
+        return dict(zip(table_names, [r.json() for r in responses]))
+
     def get_version_metadata(self, version: int = None, datastack_name: str = None):
         """get metadata about a version
 
@@ -192,11 +429,9 @@ class MaterializatonClientV2(ClientBase):
         if version is None:
             version = self.version
 
-        endpoint_mapping = self.default_url_mapping
-        endpoint_mapping["datastack_name"] = datastack_name
-        endpoint_mapping["version"] = version
-        url = self._endpoints["version_metadata"].format_map(endpoint_mapping)
-        response = self.session.get(url, verify=self._verify)
+        url = self._format_url("version_metadata",
+                               datastack_name=datastack_name, version=version)
+        response = self.session.get(url)
         self.raise_for_status(response)
         return response.json()
 
@@ -219,7 +454,8 @@ class MaterializatonClientV2(ClientBase):
             version=version, datastack_name=datastack_name)
         return datetime.strptime(meta['time_stamp'], '%Y-%m-%dT%H:%M:%S.%f')
 
-    def get_table_metadata(self, table_name: str, datastack_name=None):
+    def get_table_metadata(self, table_name: str, datastack_name=None,
+                           version=None):
         """ Get metadata about a table
 
         Parameters
@@ -229,6 +465,8 @@ class MaterializatonClientV2(ClientBase):
         datastack_name: str or None, optional,
             Name of the datastack_name.
             If None, uses the one specified in the client.
+        version: int or None, optional
+            the version to query, else use the one specified in the client.
 
 
         Returns
@@ -238,60 +476,123 @@ class MaterializatonClientV2(ClientBase):
         """
         if datastack_name is None:
             datastack_name = self.datastack_name
+        if version is None:
+            version = self.version
 
-        endpoint_mapping = self.default_url_mapping
-        endpoint_mapping["datastack_name"] = datastack_name
-        endpoint_mapping["table_name"] = table_name
+        url = self._format_url("metadata", datastack_name=datastack_name,
+                               version=version, table_name=table_name)
 
-        url = self._endpoints["metadata"].format_map(endpoint_mapping)
+        return self._get_json_cached(url)
 
-        response = self.session.get(url, verify=self._verify)
-        self.raise_for_status(response)
-        return response.json()
+    def get_tables_metadata_bulk(self, table_names, datastack_name=None,
+                                 version=None):
+        """ Get metadata about several tables with concurrent requests
+
+        Parameters
+        ----------
+        table_names (list of str):
+            names of tables to get metadata about
+        datastack_name: str or None, optional,
+            Name of the datastack_name.
+            If None, uses the one specified in the client.
+        version: int or None, optional
+            the version to query, else use the one specified in the client.
+
+        Returns
+        -------
+        dict
+            metadata about each table keyed by table name
+        """
+        if datastack_name is None:
+            datastack_name = self.datastack_name
+        if version is None:
+            version = self.version
 
-    # def get_annotation(self, table_name, annotation_ids,
-    #                    materialization_version=None,
-    #                    datastack_name=None):
-    #     """ Retrieve an annotation or annotations by id(s) and table name.
-
-    #     Parameters
-    #     ----------
-    #     table_name : str
-    #         Name of the table
-    #     annotation_ids : int or iterable
-    #         ID or IDS of the annotation to retreive
-    #     materialization_version: int or None
-    #         materialization version to use
-    #         If None, uses the one specified in the client
-    #     datastack_name : str or None, optional
-    #         Name of the datastack_name.
-    #         If None, uses the one specified in the client.
-    #     Returns
-    #     -------
-    #     list
-    #         Annotation data
-    #     """
-    #     if materialization_version is None:
-    #         materialization_version = self.version
-    #     if datastack_name is None:
-    #         datastack_name = self.datastack_name
-
-    #     endpoint_mapping = self.default_url_mapping
-    #     endpoint_mapping["datastack_name"] = datastack_name
-    #     endpoint_mapping["table_name"] = table_name
-    #     endpoint_mapping["version"] = materialization_version
-    #     url = self._endpoints["annotations"].format_map(endpoint_mapping)
-    #     try:
-    #         iter(annotation_ids)
-    #     except TypeError:
-    #         annotation_ids = [annotation_ids]
-
-    #     params = {
-    #         'annotation_ids': ",".join([str(a) for a in annotation_ids])
-    #     }
-    #     response = self.session.get(url, params=params)
-    #     self.raise_for_status(response)
-    #     return response.json()
+        urls = []
+        for table_name in table_names:
+            urls.append(self._format_url("metadata",
+                                         datastack_name=datastack_name,
+                                         version=version,
+                                         table_name=table_name))
+        return dict(zip(table_names, self._get_json_cached_concurrent(urls)))
+
+    def _get_concurrent(self, urls):
+        """GET several urls concurrently over the shared session and
+        return their responses in the same order as urls"""
+        def _get(url):
+            response = self.session.get(url)
+            self.raise_for_status(response)
+            return response
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            return list(executor.map(_get, urls))
+
+    def get_annotation(self, table_name, annotation_ids,
+                       materialization_version=None,
+                       datastack_name=None):
+        """ Retrieve an annotation or annotations by id(s) and table name.
+
+        Multiple ids are posted as a JSON list in batches of at most
+        ANNOTATION_BATCH_SIZE ids per request, so large id lists are not
+        limited by the length of the query string.
+
+        Parameters
+        ----------
+        table_name : str
+            Name of the table
+        annotation_ids : int or iterable
+            ID or IDS of the annotation to retreive
+        materialization_version: int or None
+            materialization version to use
+            If None, uses the one specified in the client
+        datastack_name : str or None, optional
+            Name of the datastack_name.
+            If None, uses the one specified in the client.
+        Returns
+        -------
+        list
+            Annotation data
+        """
+        if materialization_version is None:
+            materialization_version = self.version
+        if datastack_name is None:
+            datastack_name = self.datastack_name
+
+        url = self._format_url("annotations", datastack_name=datastack_name,
+                               version=materialization_version,
+                               table_name=table_name)
+        if isinstance(annotation_ids, (str, bytes)):
+            raise TypeError('annotation_ids must be an integer or an iterable '
+                            'of integers, not a string')
+        if isinstance(annotation_ids, (int, np.integer)):
+            annotation_ids = [annotation_ids]
+        annotation_ids = _annotation_id_array(annotation_ids)
+        if len(annotation_ids) == 0:
+            return []
+
+        if len(annotation_ids) == 1:
+            params = {'annotation_ids': str(annotation_ids[0])}
+            response = self.session.get(url, params=params)
+            self.raise_for_status(response)
+            return response.json()
+
+        annotations = []
+        for i in range(0, len(annotation_ids), ANNOTATION_BATCH_SIZE):
+            data = {'annotation_ids': annotation_ids[i:i + ANNOTATION_BATCH_SIZE]}
+            response = self._post(url, _dumps(data),
+                                  headers={'Content-Type': 'application/json'})
+            self.raise_for_status(response)
+            annotations.extend(response.json())
+        return annotations
+
+    async def aget_annotation(self, *args, **kwargs):
+        """Coroutine version of get_annotation.
+
+        Runs get_annotation in a worker thread over the shared session so
+        several calls can be awaited together, e.g. with asyncio.gather.
+        Takes the same arguments as get_annotation.
+        """
+        return await self._run_in_executor(self.get_annotation, *args, **kwargs)
 
     def query_table(self,
                     table: str,
@@ -304,7 +605,8 @@ class MaterializatonClientV2(ClientBase):
                     offset: int = None,
                     limit: int = None,
                     datastack_name: str = None,
-                    materialization_version: int = None):
+                    materialization_version: int = None,
+                    return_format: str = 'arrow'):
         """generic query on materialization tables
 
         Args:
@@ -329,31 +631,125 @@ class MaterializatonClientV2(ClientBase):
                 If None defaults to one specified in client. 
             materialization_version (int, optional): version to query. 
                 If None defaults to one specified in client.
+            return_format (str, optional): 'arrow' to request an Arrow IPC
+                stream from the server, falling back to the legacy format if
+                the server does not support it. None to always use the legacy
+                format. Defaults to 'arrow'.
         Returns:
         pd.DataFrame: a pandas dataframe of results of query
 
         """
+        url, data = self._query_table_request(table,
+                                              filter_in_dict=filter_in_dict,
+                                              filter_out_dict=filter_out_dict,
+                                              filter_equal_dict=filter_equal_dict,
+                                              select_columns=select_columns,
+                                              offset=offset,
+                                              limit=limit,
+                                              datastack_name=datastack_name,
+                                              materialization_version=materialization_version)
+        return self._post_query(url, data, return_format=return_format)
+
+    def iter_query_table(self,
+                         table: str,
+                         filter_in_dict=None,
+                         filter_out_dict=None,
+                         filter_equal_dict=None,
+                         select_columns=None,
+                         offset: int = None,
+                         limit: int = None,
+                         datastack_name: str = None,
+                         materialization_version: int = None):
+        """query_table in a single streamed request, returning an iterator
+        over the results in chunks instead of paging with offset and limit
+
+        Takes the same arguments as query_table except return_format, an
+        Arrow IPC stream is always requested. The request is sent when this
+        is called, so bad arguments and HTTP errors are raised here rather
+        than on the first next(). If the server sends an Arrow IPC stream,
+        one dataframe is yielded per record batch, otherwise the whole result
+        is yielded as a single dataframe. With transport='httpx' the response
+        body is read in full before the first batch is decoded.
+
+        The response stays open until the iterator is exhausted or closed.
+
+        Returns:
+        iterator of pd.DataFrame: pandas dataframes of consecutive parts of
+            the results of query
+
+        """
+        url, data = self._query_table_request(table,
+                                              filter_in_dict=filter_in_dict,
+                                              filter_out_dict=filter_out_dict,
+                                              filter_equal_dict=filter_equal_dict,
+                                              select_columns=select_columns,
+                                              offset=offset,
+                                              limit=limit,
+                                              datastack_name=datastack_name,
+                                              materialization_version=materialization_version)
+        response = self._send_query(url, _dumps(data), return_format='arrow',
+                                    stream=True)
+        return self._iter_query_response(response)
+
+    def _iter_query_response(self, response):
+        """yield dataframes from an open query response, closing it when
+        done"""
+        try:
+            if self._transport == 'httpx':
+                response.read()
+            content_type = response.headers.get('Content-Type', '')
+            if not content_type.startswith(ARROW_STREAM_MIME):
+                yield _deserialize_query_response(response)
+                return
+            if self._transport == 'httpx':
+                source = pa.py_buffer(response.content)
+            else:
+                # let urllib3 undo any gzip content encoding while reading
+                response.raw.decode_content = True
+                source = response.raw
+            for batch in pa.ipc.open_stream(source):
+                yield batch.to_pandas()
+        finally:
+            response.close()
+
+    async def aquery_table(self, *args, **kwargs):
+        """Coroutine version of query_table.
+
+        Runs query_table in a worker thread over the shared session so
+        several queries can be awaited together, e.g. with asyncio.gather.
+        Takes the same arguments as query_table.
+        """
+        return await self._run_in_executor(self.query_table, *args, **kwargs)
+
+    def _run_in_executor(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    def _query_table_request(self,
+                             table: str,
+                             filter_in_dict=None,
+                             filter_out_dict=None,
+                             filter_equal_dict=None,
+                             select_columns=None,
+                             offset: int = None,
+                             limit: int = None,
+                             datastack_name: str = None,
+                             materialization_version: int = None):
+        """build the url and request body for query_table"""
         if materialization_version is None:
             materialization_version = self.version
         if datastack_name is None:
             datastack_name = self.datastack_name
 
-        endpoint_mapping = self.default_url_mapping
-        endpoint_mapping["datastack_name"] = datastack_name
-        endpoint_mapping["version"] = materialization_version
+        if not isinstance(table, str):
+            raise ValueError('query_table takes a single table name, '
+                             'use join_query to query multiple tables')
+
         data = {}
-        query_args = {}
-        if type(table) == str:
-            tables = [table]
-        if len(tables) == 1:
-            assert(type(tables[0]) == str)
-            endpoint_mapping["table_name"] = tables[0]
-            single_table = True
-            url = self._endpoints["simple_query"].format_map(endpoint_mapping)
-        else:
-            single_table = False
-            data['tables'] = tables
-            url = self._endpoints["join_query"].format_map(endpoint_mapping)
+        url = self._format_url("simple_query",
+                               datastack_name=datastack_name,
+                               version=materialization_version,
+                               table_name=table)
 
         if filter_in_dict is not None:
             data['filter_in_dict'] = {table: filter_in_dict}
@@ -368,12 +764,55 @@ class MaterializatonClientV2(ClientBase):
         if limit is not None:
             assert(limit > 0)
             data['limit'] = limit
-        response = self.session.post(url, data=json.dumps(data, cls=MEEncoder),
-                                     headers={
-                                         'Content-Type': 'application/json'},
-                                     verify=self._verify)
-        self.raise_for_status(response)
-        return pa.deserialize(response.content)
+        return url, data
+
+    def prepare_query(self,
+                      table: str,
+                      id_column: str,
+                      filter_in_dict=None,
+                      filter_out_dict=None,
+                      filter_equal_dict=None,
+                      select_columns=None,
+                      offset: int = None,
+                      limit: int = None,
+                      datastack_name: str = None,
+                      materialization_version: int = None,
+                      return_format: str = 'arrow'):
+        """prepare a query_table call that is repeated for different batches
+        of values of one column
+
+        The static part of the request is serialized once, so that each
+        run only needs to serialize the new values.
+
+        Args:
+            table: 'str'
+            id_column (str): column whose allowed entries are supplied
+                to PreparedQuery.run
+            filter_in_dict, filter_out_dict, filter_equal_dict, select_columns,
+            offset, limit, datastack_name, materialization_version,
+            return_format: as in query_table. filter_in_dict may not contain
+                id_column.
+        Returns:
+        PreparedQuery: call its run method with a list or array of values
+            of id_column to get a pandas dataframe of results of query
+
+        """
+        filter_in_dict = dict(filter_in_dict or {})
+        if id_column in filter_in_dict:
+            raise ValueError(f'{id_column} is supplied by PreparedQuery.run '
+                             'and cannot also be in filter_in_dict')
+        filter_in_dict[id_column] = PREPARED_QUERY_PLACEHOLDER
+        url, data = self._query_table_request(table,
+                                              filter_in_dict=filter_in_dict,
+                                              filter_out_dict=filter_out_dict,
+                                              filter_equal_dict=filter_equal_dict,
+                                              select_columns=select_columns,
+                                              offset=offset,
+                                              limit=limit,
+                                              datastack_name=datastack_name,
+                                              materialization_version=materialization_version)
+        prefix, suffix = _dumps(data).split(_dumps(PREPARED_QUERY_PLACEHOLDER))
+        return PreparedQuery(self, url, prefix, suffix, return_format)
 
     def join_query(self,
                    tables,
@@ -387,7 +826,8 @@ class MaterializatonClientV2(ClientBase):
                    limit: int = None,
                    suffixes: list = None,
                    datastack_name: str = None,
-                   materialization_version: int = None):
+                   materialization_version: int = None,
+                   return_format: str = 'arrow'):
         """generic query on materialization tables
 
         Args:
@@ -415,6 +855,10 @@ class MaterializatonClientV2(ClientBase):
                 If None defaults to one specified in client. 
             materialization_version (int, optional): version to query. 
                 If None defaults to one specified in client.
+            return_format (str, optional): 'arrow' to request an Arrow IPC
+                stream from the server, falling back to the legacy format if
+                the server does not support it. None to always use the legacy
+                format. Defaults to 'arrow'.
         Returns:
         pd.DataFrame: a pandas dataframe of results of query
 
@@ -424,14 +868,12 @@ class MaterializatonClientV2(ClientBase):
         if datastack_name is None:
             datastack_name = self.datastack_name
 
-        endpoint_mapping = self.default_url_mapping
-        endpoint_mapping["datastack_name"] = datastack_name
-        endpoint_mapping["version"] = materialization_version
         data = {}
         query_args = {}
 
         data['tables'] = tables
-        url = self._endpoints["join_query"].format_map(endpoint_mapping)
+        url = self._format_url("join_query", datastack_name=datastack_name,
+                               version=materialization_version)
 
         if filter_in_dict is not None:
             data['filter_in_dict'] = filter_in_dict
@@ -448,12 +890,79 @@ class MaterializatonClientV2(ClientBase):
         if limit is not None:
             assert(limit > 0)
             data['limit'] = limit
-        response = self.session.post(url, data=json.dumps(data, cls=MEEncoder),
-                                     headers={
-                                         'Content-Type': 'application/json'},
-                                     verify=self._verify)
+        return self._post_query(url, data, return_format=return_format)
+
+    def _post(self, url, body, headers=None, stream=False):
+        """post a serialized body with either transport"""
+        if self._transport == 'httpx':
+            request = self.session.build_request('POST', url, content=body,
+                                                 headers=headers)
+            return self.session.send(request, stream=stream)
+        return self.session.post(url, data=body, headers=headers,
+                                 stream=stream)
+
+    def _post_query(self, url, data, return_format='arrow'):
+        """post a query and decode the response into a dataframe"""
+        return self._post_query_body(url, _dumps(data),
+                                     return_format=return_format)
+
+    def _post_query_body(self, url, body, return_format='arrow'):
+        """post an already serialized query and decode the response
+        into a dataframe"""
+        response = self._send_query(url, body, return_format=return_format)
+        return _deserialize_query_response(response)
+
+    def _send_query(self, url, body, return_format='arrow', stream=False):
+        """post an already serialized query, falling back to the legacy
+        format if the server cannot send an arrow stream"""
+        headers = {'Content-Type': 'application/json'}
+        if return_format == 'arrow':
+            headers['Accept'] = ARROW_STREAM_MIME
+        elif return_format is not None:
+            raise ValueError(f'Unknown return_format {return_format}')
+        if self._compress_requests and len(body) > COMPRESSION_THRESHOLD:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        response = self._post(url, body, headers=headers, stream=stream)
+        if response.status_code == 406 and 'Accept' in headers:
+            response.close()
+            del headers['Accept']
+            response = self._post(url, body, headers=headers, stream=stream)
+        if stream and self._transport == 'httpx' and response.status_code >= 400:
+            # a streamed httpx response has no content until it is read
+            response.read()
         self.raise_for_status(response)
-        return pa.deserialize(response.content)
+        return response
+
+
+class PreparedQuery(object):
+    """A query_table request whose static part is already serialized.
+
+    Created by MaterializatonClientV2.prepare_query.
+    """
+
+    def __init__(self, client, url, prefix, suffix, return_format='arrow'):
+        self._client = client
+        self._url = url
+        self._prefix = prefix
+        self._suffix = suffix
+        self._return_format = return_format
+
+    @property
+    def url(self):
+        return self._url
+
+    def run(self, ids):
+        """Run the query with ids as the allowed entries of the id column
+
+        Args:
+            ids (list or np.ndarray): allowed entries of the id column
+        Returns:
+        pd.DataFrame: a pandas dataframe of results of query
+        """
+        body = self._prefix + _dumps(ids) + self._suffix
+        return self._client._post_query_body(self._url, body,
+                                             return_format=self._return_format)
 
 
 client_mapping = {2: MaterializatonClientV2,